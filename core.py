@@ -1,140 +1,266 @@
 from datetime import date
 from datetime import timedelta
+from functools import lru_cache
+from operator import attrgetter
+from operator import itemgetter
 
+from rich.markup import escape
 from rich.table import Table
+from rich.text import Text
 
 from models import Emprestimo
 from models import Obra
 from models import Usuario
 
-class Acervo:
-    """Acervo, realiza e manipula empréstimos, armazena estoque de obras                     
+_SETE_DIAS = timedelta(days=7)
 
-    Armazena as obras em um dicionário em que as keys são seus ids, realiza a manipulação total dos empréstimos
-    E possui uma classe interna responsável por criar relatórios
-    
-    Attributes:
-        estoque (dict): dicionário no formato {obra.titulo: obra.quantidade}
-        emprestimos_ativos (list): lista de todos empréstimos em vigor
+def _formatar_reais(valor: float) -> str:
+    """Formata um valor em reais no padrão brasileiro, sem passar por str.replace.
+
+    Args:
+        valor (float): valor em reais
+
+    Returns:
+        str: 'R$ x,yy'
     """
+    reais, centavos = divmod(round(valor * 100), 100)
+    return f'R$ {reais},{centavos:02d}'
 
-    __slots__ = ['estoque', 'emprestimos_ativos']
+@lru_cache(maxsize=4096)
+def _formatar_data(data: date) -> str:
+    """Formata uma data no padrão dd/mm/aa, com cache, já que muitos empréstimos compartilham as mesmas datas.
 
-    class _RelatorioBuilder:
-        def relatorio_inventario(self, acervo) -> Table:
-            """Cria uma tabela do inventário de um Acervo.
-            
-            Args:
-                acervo (Acervo): Acervo do respectivo inventário
-            
-            Returns:
-                Table: Retorna a tabela de obras.
-            """
-            tabela = Table(title='Inventário do Acervo')
+    Args:
+        data (date): data que será formatada
+
+    Returns:
+        str: 'dd/mm/aa'
+    """
+    return data.strftime('%d/%m/%y')
 
-            tabela.add_column('Obra', justify='center')
-            tabela.add_column('Quantidade', justify='left')
+def relatorio_inventario(acervo) -> Table:
+    """Cria uma tabela do inventário de um Acervo.
 
-            estoque_ordenado = dict(sorted(acervo.estoque.items(), key=lambda item: item[1]))
+    Args:
+        acervo (Acervo): Acervo do respectivo inventário
 
-            for obra, qnt in estoque_ordenado.items():
-                tabela.add_row(obra, str(qnt))
+    Returns:
+        Table: Retorna a tabela de obras.
+    """
+    tabela = Table(title='Inventário do Acervo')
 
-            return tabela
-        
-        def relatorio_debitos_usuario(self, user: Usuario) -> Table:
-            """Cria uma tabela de débitos de um usuário específico.
-            
-            Args:
-                user (Usuario): Usuário responsável pelos débitos
-            
-            Returns:
-                Table: Retorna a tabela de débitos.
-            """
-            tabela = Table(title=f'Débitos de {user}')
+    tabela.add_column('Obra', justify='center')
+    tabela.add_column('Quantidade', justify='left')
 
-            tabela.add_column('Motivo', justify='center')
-            tabela.add_column('Quantia', justify='left')
+    estoque = acervo.estoque_ordenado()
+    if not estoque:
+        return tabela
 
-            if not user.debitos:
-                tabela.add_row('N/A', 'N/A')
-                return tabela
+    titulos, quantidades = zip(*estoque)
 
-            for mot, qnt in user.debitos.items():
-                tabela.add_row(mot, qnt)
+    add_row = tabela.add_row
+    for obra, qnt in zip(titulos, map(str, quantidades)):
+        add_row(Text(obra), qnt)
 
-            return tabela
-        
-        def relatorio_movimentacoes_usuario(self, user: Usuario) -> Table:
-            """Cria uma tabela de movimentações de um usuário específico.
-            
-            Args:
-                user (Usuario): Usuário responsável pelas movimentações
-                
-            Returns:
-                Table: Retorna a tabela de movimentações.
-            """
-            tabela = Table(title=f'Movimentações de {user}')
-
-            tabela.add_column('Obra', justify='center')
-            tabela.add_column('Estado', justify='center')
-            tabela.add_column('Data prevista de devolução', justify='right')
-            tabela.add_column('Data de devolução', justify='right')
-
-            def estado(emprestimo: Emprestimo) -> str:
-                """Função interna para verificar se o empréstimo foi devolvido e retornar uma string coerente.
-                
-                Args:
-                    emprestimo (Emprestimo): emprestimo que está sendo verificado.
-                    
-                Returns:
-                    str: retorna "Devolvido", "Atrasado ( x dias )" ou "Em dia", a depender da verificação.
-                """
-                if emprestimo.data_dev_real:
-                    return 'Devolvido'
-                elif emprestimo.dias_atraso():
-                    return f'Atrasado ( {emprestimo.dias_atraso()} dias )'
-                return 'Em dia'
-
-            def data_dev(emprestimo: Emprestimo) -> str:
-                """Função interna para verificar se o empréstimo foi devolvido e retornar uma string coerente.
-                
-                Args:
-                    emprestimo (Emprestimo): emprestimo que está sendo verificado.
-                    
-                Returns:
-                    str: retorna a data, caso esteja em andamento, retorna "...".
-                """
-                if emprestimo.data_dev_real:
-                    return emprestimo.data_dev_real.strftime('%d/%m/%y')
-                return '...'
-
-            if not user.emprestimos:
-                tabela.add_row('N/A', 'N/A', 'N/A', 'N/A')
-                return tabela
-
-            emp: Emprestimo
-            for emp in user.emprestimos:
-                tabela.add_row(emp.obra.titulo, estado(emp), str(emp.data_prev_devol.strftime('%d/%m/%y')), data_dev(emp))
-
-            return tabela
-
-        def relatorio_historico_users(self) -> Table:
-            pass
-
-        def relatorio_emprestimos_ativos(self, acervo) -> Table:
-            pass
-
-        def relatorio_historico_emprestimos(self) -> Table:
-            pass
-
-        def relatorio_completo(self, acervo, user: Usuario) -> Table:
-            pass
+    return tabela
+
+def relatorio_debitos_usuario(user: Usuario) -> Table:
+    """Cria uma tabela de débitos de um usuário específico.
+
+    Args:
+        user (Usuario): Usuário responsável pelos débitos
+
+    Returns:
+        Table: Retorna a tabela de débitos.
+    """
+    tabela = Table(title=f'Débitos de {escape(str(user))}')
+
+    tabela.add_column('Motivo', justify='center')
+    tabela.add_column('Quantia', justify='left')
+
+    if not user.debitos:
+        tabela.add_row('N/A', 'N/A')
+        return tabela
+
+    total = 0.0
+    for emp, data, valor in user.debitos:
+        tabela.add_row(Text(f'Multa de atraso na devolução de {emp.obra}, ocorreu em {_formatar_data(data)}.'), _formatar_reais(valor))
+        total += valor
+    tabela.caption = f'Total: {_formatar_reais(total)}'
+
+    return tabela
+
+def relatorio_movimentacoes_usuario(user: Usuario) -> Table:
+    """Cria uma tabela de movimentações de um usuário específico.
+
+    Args:
+        user (Usuario): Usuário responsável pelas movimentações
+
+    Returns:
+        Table: Retorna a tabela de movimentações.
+    """
+    tabela = Table(title=f'Movimentações de {escape(str(user))}')
+
+    tabela.add_column('Obra', justify='center')
+    tabela.add_column('Estado', justify='center')
+    tabela.add_column('Data prevista de devolução', justify='right')
+    tabela.add_column('Data de devolução', justify='right')
+
+    if not user.emprestimos:
+        tabela.add_row('N/A', 'N/A', 'N/A', 'N/A')
+        return tabela
+
+    add_row = tabela.add_row
+
+    emp: Emprestimo
+    for emp in user.emprestimos:
+        data_dev_real = emp.data_dev_real
+        if data_dev_real:
+            estado = 'Devolvido'
+            data_dev = _formatar_data(data_dev_real)
+        else:
+            atraso = emp.dias_atraso()
+            estado = f'Atrasado ( {atraso} dias )' if atraso else 'Em dia'
+            data_dev = '...'
+        add_row(Text(emp.obra.titulo), estado, _formatar_data(emp.data_prev_devol), data_dev)
+
+    return tabela
+
+def relatorio_historico_users() -> Table:
+    """Cria uma tabela dos usuários ainda em uso, em ordem alfabética.
+
+    Usuario.historico é um WeakSet, então usuários que não são mais referenciados em lugar nenhum
+    não aparecem, já quem fez algum empréstimo continua referenciado por Emprestimo.historico e sempre aparece
+
+    Returns:
+        Table: Retorna a tabela de usuários.
+    """
+    tabela = Table(title='Histórico de usuários')
+
+    tabela.add_column('Nome', justify='center')
+    tabela.add_column('Email', justify='center')
+    tabela.add_column('Empréstimos', justify='left')
+    tabela.add_column('Débitos', justify='left')
+
+    if not Usuario.historico:
+        tabela.add_row('N/A', 'N/A', 'N/A', 'N/A')
+        return tabela
+
+    add_row = tabela.add_row
+    for user in sorted(Usuario.historico, key=attrgetter('nome')):
+        add_row(Text(user.nome), Text(user.email), str(len(user.emprestimos)), str(len(user.debitos)))
+
+    return tabela
+
+def relatorio_emprestimos_ativos(acervo) -> Table:
+    """Cria uma tabela dos empréstimos em vigor de um Acervo, com a multa prevista de cada um.
+
+    Args:
+        acervo (Acervo): Acervo dos respectivos empréstimos
+
+    Returns:
+        Table: Retorna a tabela de empréstimos ativos.
+    """
+    tabela = Table(title='Empréstimos ativos')
+
+    tabela.add_column('Obra', justify='center')
+    tabela.add_column('Usuário', justify='center')
+    tabela.add_column('Estado', justify='center')
+    tabela.add_column('Data prevista de devolução', justify='right')
+    tabela.add_column('Multa prevista', justify='left')
+
+    if not acervo.emprestimos_ativos:
+        tabela.add_row('N/A', 'N/A', 'N/A', 'N/A', 'N/A')
+        return tabela
+
+    #Mesma passada sobre a coluna de vencimentos do emp_hist, indexada por emp._idx
+    atrasos = Emprestimo.dias_atraso_todos()
+
+    add_row = tabela.add_row
+    for emp in acervo.emprestimos_ativos.values():
+        atraso = atrasos[emp._idx]
+        if atraso:
+            estado = f'Atrasado ( {atraso} dias )'
+            multa = _formatar_reais(acervo.valor_multa(emp, atraso))
+        else:
+            estado = 'Em dia'
+            multa = 'N/A'
+        add_row(Text(emp.obra.titulo), Text(str(emp.usuario)), estado, _formatar_data(emp.data_prev_devol), multa)
+
+    return tabela
+
+def relatorio_historico_emprestimos() -> Table:
+    """Cria uma tabela de todos os empréstimos já registrados, com a contagem de atrasados na legenda.
+
+    Returns:
+        Table: Retorna a tabela de empréstimos.
+    """
+    tabela = Table(title='Histórico de empréstimos')
+
+    tabela.add_column('Obra', justify='center')
+    tabela.add_column('Usuário', justify='center')
+    tabela.add_column('Estado', justify='center')
+    tabela.add_column('Data prevista de devolução', justify='right')
+    tabela.add_column('Data de devolução', justify='right')
+
+    if not Emprestimo.historico:
+        tabela.add_row('N/A', 'N/A', 'N/A', 'N/A', 'N/A')
+        return tabela
+
+    #Uma passada só sobre a coluna de vencimentos, indexada por emp._idx
+    atrasos = Emprestimo.dias_atraso_todos()
+    atrasados = 0
+
+    add_row = tabela.add_row
+    for emp in Emprestimo.historico:
+        data_dev_real = emp.data_dev_real
+        if data_dev_real:
+            estado = 'Devolvido'
+            data_dev = _formatar_data(data_dev_real)
+        else:
+            atraso = atrasos[emp._idx]
+            if atraso:
+                estado = f'Atrasado ( {atraso} dias )'
+                atrasados += 1
+            else:
+                estado = 'Em dia'
+            data_dev = '...'
+        add_row(Text(emp.obra.titulo), Text(str(emp.usuario)), estado, _formatar_data(emp.data_prev_devol), data_dev)
+    tabela.caption = f'Atrasados: {atrasados}'
+
+    return tabela
+
+def relatorio_completo(acervo, user: Usuario) -> Table:
+    pass
+
+class Acervo:
+    """Acervo, realiza e manipula empréstimos, armazena estoque de obras                     
+
+    Armazena as obras em um dicionário em que as keys são seus ids, realiza a manipulação total dos empréstimos
+    E usa as funções relatorio_* deste módulo para criar relatórios
+    
+    Attributes:
+        estoque (dict): dicionário no formato {obra.titulo: obra.quantidade}
+        emprestimos_ativos (dict): todos empréstimos em vigor, no formato {id(emprestimo): emprestimo}
+        _estoque_ordenado (list): cache do estoque ordenado por quantidade, None caso precise ser refeito
+    """
+
+    __slots__ = ['estoque', 'emprestimos_ativos', '_estoque_ordenado']
+
+    _REL_DISPATCH = {
+        'inv': lambda acervo, user: relatorio_inventario(acervo),
+        'user_deb': lambda acervo, user: relatorio_debitos_usuario(user),
+        'user_mov': lambda acervo, user: relatorio_movimentacoes_usuario(user),
+        'user_hist': lambda acervo, user: relatorio_historico_users(),
+        'emp_ativos': lambda acervo, user: relatorio_emprestimos_ativos(acervo),
+        'emp_hist': lambda acervo, user: relatorio_historico_emprestimos(),
+        'all': lambda acervo, user: relatorio_completo(acervo, user), #Para fazer
+    }
 
     def _relatorio_builder(self, type: str = 'inv', user: Usuario = None) -> Table:
         """Faz um relatório baseado no tipo solicitado.
         
-        ('inv', 'user_deb', 'user_mov')
+        ('inv', 'user_deb', 'user_mov', 'user_hist', 'emp_ativos', 'emp_hist')
         
         Args: 
             type (str): tipo de relatório, ver tupla acima.
@@ -142,31 +268,18 @@ class Acervo:
             
         Returns:
             Table: retorna o relatório
+
+        Raises:
+            KeyError: Ocorre caso o tipo de relatório não exista
         """
-        rel_builder = self._RelatorioBuilder()
-        match type:
-            case 'inv':
-                rel = rel_builder.relatorio_inventario(self)
-            case 'user_deb':
-                rel = rel_builder.relatorio_debitos_usuario(user)
-            case 'user_mov':
-                rel = rel_builder.relatorio_movimentacoes_usuario(user)
-            case 'user_hist':
-                rel = rel_builder.relatorio_historico_users() #Para fazer
-            case 'emp_ativos':
-                rel = rel_builder.relatorio_emprestimos_ativos(self) #Para fazer
-            case 'emp_hist':
-                rel = rel_builder.relatorio_historico_emprestimos() #Para fazer
-            case 'all':
-                rel = rel_builder.relatorio_completo(self, user) #Para fazer
-            case _:
-                pass        
-        return rel
+        return Acervo._REL_DISPATCH[type](self, user)
+
     def __init__(self) -> None:
         """Inicializa Acervo
         """
         self.estoque = {}  
-        self.emprestimos_ativos = []
+        self.emprestimos_ativos = {}
+        self._estoque_ordenado = None
 
     def __iadd__(self, obra: Obra):
         """Função do operador +=, adiciona uma obra no estoque, caso já esteja nele, +1 quantidade
@@ -174,9 +287,16 @@ class Acervo:
         Args:
             obra (Obra): obra que está sendo incrementada ao estoque
         """
-        if obra.titulo in self.estoque:
-            obra.quantidade += 1
-        self.estoque[obra.titulo] = obra.quantidade
+        titulo = obra.titulo
+        atual = self.estoque.get(titulo)
+        if atual is None:
+            if obra.quantidade <= 0:
+                obra.quantidade = 1
+                #Obra que saiu do estoque ao chegar em 0, volta com 1 unidade
+        else:
+            obra.quantidade = atual + 1
+        self.estoque[titulo] = obra.quantidade
+        self._estoque_ordenado = None
 
         return self
 
@@ -186,17 +306,34 @@ class Acervo:
         Args:
             obra (Obra): Obra que está sendo decrementada do estoque
         """
-        if obra.titulo in self.estoque:
-            obra.quantidade -= 1
-            self.estoque[obra.titulo] = obra.quantidade
+        estoque = self.estoque
+        titulo = obra.titulo
+        quantidade = estoque.get(titulo)
+        if quantidade is None:
+            return self
+
+        quantidade -= 1
+        obra.quantidade = quantidade
+        if quantidade <= 0:
+            del estoque[titulo]
         else:
-            pass
-
-        if obra.quantidade <= 0:
-            self.estoque.pop(obra.titulo)
+            estoque[titulo] = quantidade
+        self._estoque_ordenado = None
 
         return self
 
+    def estoque_ordenado(self) -> list:
+        """Retorna o estoque ordenado por quantidade, de forma crescente.
+
+        A ordenação só é refeita depois que o estoque muda ( += ou -= ), caso contrário reutiliza a lista anterior
+
+        Returns:
+            list: lista no formato [(obra.titulo, obra.quantidade)], não deve ser modificada
+        """
+        if self._estoque_ordenado is None:
+            self._estoque_ordenado = sorted(self.estoque.items(), key=itemgetter(1))
+        return self._estoque_ordenado
+
     def adicionar(self, obra: Obra) -> None:
         """Interface explícita para +=
         
@@ -229,69 +366,98 @@ class Acervo:
         Raises:
             ValueError: Ocorre caso a obra não esteja em estoque    
         """
-        if obra.disponivel(self.estoque):
-            emp = Emprestimo(obra, usuario, date.today() + timedelta(days=dias))
-            self.remover(obra)
-            self.emprestimos_ativos.append(emp)
-            usuario.emprestimos.append(emp)
-            return emp
-        else:
+        titulo = obra.titulo
+        quantidade = self.estoque.get(titulo, 0)
+        if quantidade <= 0:
             raise ValueError
 
-    def devolver(self, emprestimo: Emprestimo, data_dev: date = date.today()) -> None:
+        #Mesmo efeito de self.remover(obra), mas sem consultar o estoque de novo
+        quantidade -= 1
+        if quantidade == 0:
+            del self.estoque[titulo]
+        else:
+            self.estoque[titulo] = quantidade
+        obra.quantidade = quantidade
+        self._estoque_ordenado = None
+
+        emp = Emprestimo(obra, usuario, date.today() + timedelta(days=dias))
+        self.emprestimos_ativos[id(emp)] = emp
+        usuario.emprestimos.append(emp)
+        return emp
+
+    def devolver(self, emprestimo: Emprestimo, data_dev: date = None) -> None:
         """Finaliza um empréstimo, retornando a obra ao estoque
         
         Args:
             emprestimo (Emprestimo): Empréstimo realizado
             data_dev (date): Data em que a obra foi devolvida ( por padrão o dia atual )
+
+        Raises:
+            ValueError: Ocorre caso o empréstimo não esteja em vigor
         """
+        if self.emprestimos_ativos.pop(id(emprestimo), None) is None:
+            raise ValueError
+
+        if data_dev is None:
+            data_dev = date.today()
+
         self.multar_se_atrasado(emprestimo)
 
         self.adicionar(emprestimo.obra)
         emprestimo.marcar_devolucao(data_dev)
-        self.emprestimos_ativos.remove(emprestimo)
     
-    def renovar(self, emprestimo: Emprestimo, dias_extras: timedelta = timedelta(days=7)) -> None:
+    def renovar(self, emprestimo: Emprestimo, dias_extras: timedelta = _SETE_DIAS) -> None:
         """Adia a data de devolução de um empréstimo
         
         Args:
             emprestimo (Emprestimo): Empréstimo realizado
             dias_extras (timedelta): Dias adicionados
         """
-        if emprestimo.dias_atraso() > dias_extras:
+        hoje = date.today()
+        atraso = emprestimo.dias_atraso(hoje)
+        if atraso > dias_extras.days:
             return
             #Atraso tão grande que mesmo renovando ainda está atrasado, ainda estou vendo o que vou fazer
 
-        self.multar_se_atrasado(emprestimo)
+        self.multar_se_atrasado(emprestimo, atraso, hoje)
         emprestimo.data_prev_devol += dias_extras
 
-    def valor_multa(self, emprestimo: Emprestimo) -> float:
+    def valor_multa(self, emprestimo: Emprestimo, atraso: int = None) -> float:
         """Calcula a multa sobre o atraso entre a data_prev_dev e a data_ref
 
         A multa é de R$ 1,00 por dia de atraso
         
         Args:
             emprestimo (Emprestimo): Empréstimo realizado
-            data_ref (date): Data de referência ( por padrão o dia atual )
+            atraso (int): Dias de atraso já calculados, caso None, usa emprestimo.dias_atraso()
 
         Returns:
             float: Retorna o valor da multa em reais
         """
-        return float(emprestimo.dias_atraso())
+        if atraso is None:
+            atraso = emprestimo.dias_atraso()
+        return float(atraso)
 
-    def multar_se_atrasado(self, emprestimo: Emprestimo) -> None:
+    def multar_se_atrasado(self, emprestimo: Emprestimo, atraso: int = None, hoje: date = None) -> None:
         """Verifica se o empréstimo está atrasado, e multa caso esteja
         
         Args:
             emprestimo (Emprestimo): emprestimo sendo verificado
+            atraso (int): Dias de atraso já calculados, caso None, usa emprestimo.dias_atraso()
+            hoje (date): Data atual já calculada, útil ao multar vários empréstimos de uma vez ( por padrão date.today() )
         """
-        if emprestimo.dias_atraso():
-            emprestimo.usuario.debitos[f'Multa de atraso na devolução de {emprestimo.obra}, ocorreu em {date.today().strftime('%d/%m/%y')}.'] = f'R$ {self.valor_multa(emprestimo)}'.replace('.', ',')
-
-    def _valida_obra(self, obra: Obra) -> bool:
+        if hoje is None:
+            hoje = date.today()
+        if atraso is None:
+            atraso = emprestimo.dias_atraso(hoje)
+        if atraso:
+            emprestimo.usuario.debitos.append((emprestimo, hoje, self.valor_multa(emprestimo, atraso)))
+
+    def _valida_obra(self, obra: Obra) -> None:
         """Valida se uma obra é de fato da classe Obra
 
         Mesma função que isInstance(obra, Obra), não usado
+        Verifica type(obra) is Obra primeiro, o caso comum, e só percorre o MRO com isinstance para subclasses
         
         Args:
             obra (Obra): Obra que está sendo verificada
@@ -299,5 +465,5 @@ class Acervo:
         Raises:
             TypeError: Caso a obra não seja da classe Obra
         """
-        if not isinstance(obra, Obra):
+        if type(obra) is not Obra and not isinstance(obra, Obra):
             raise TypeError
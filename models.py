@@ -1,22 +1,116 @@
+from array import array
+from collections import deque
 from datetime import date
 from datetime import timedelta
-import uuid
+from weakref import WeakSet
+import os
+import sys
+import threading
+
+_SETE_DIAS = timedelta(days=7)
+
+_IDS_POR_LOTE = 4096
+
+#Bits de versão ( 4 ) e variante ( RFC 4122 ), os mesmos que o uuid4() coloca, repetidos para cada id do lote
+_MASCARA_AND = int.from_bytes((b'\xff' * 6 + b'\x0f\xff\x3f' + b'\xff' * 7) * _IDS_POR_LOTE, 'big')
+_MASCARA_OR = int.from_bytes((bytes(6) + b'\x40\x00\x80' + bytes(7)) * _IDS_POR_LOTE, 'big')
+
+_datas_criacao = {}
+
+_lote_ids = b''
+_pos_lote_ids = 0
+_trava_ids = threading.Lock()
+_trava_vencimentos = threading.Lock()
+
+def _novo_id() -> bytes:
+    """Gera os 16 bytes de um UUID versão 4, tirando os bytes aleatórios de um lote.
+
+    Um único os.urandom() é feito a cada _IDS_POR_LOTE ids, em vez de um por entidade criada.
+    O lote é protegido por _trava_ids, para que duas threads nunca recebam os mesmos bytes.
+    Guardar bytes em vez de UUID deixa o == do id uma comparação direta, caso precise, UUID(bytes=id) converte.
+
+    Returns:
+        bytes: um id único de 16 bytes, com os bits de versão e variante do RFC 4122
+    """
+    global _lote_ids, _pos_lote_ids
+    with _trava_ids:
+        if _pos_lote_ids >= len(_lote_ids):
+            #As máscaras são aplicadas no lote inteiro de uma vez, como um único inteiro
+            lote = int.from_bytes(os.urandom(16 * _IDS_POR_LOTE), 'big')
+            _lote_ids = ((lote & _MASCARA_AND) | _MASCARA_OR).to_bytes(16 * _IDS_POR_LOTE, 'big')
+            _pos_lote_ids = 0
+        novo_id = _lote_ids[_pos_lote_ids:_pos_lote_ids + 16]
+        _pos_lote_ids += 16
+    return novo_id
+
+def _descartar_lote_ids() -> None:
+    """Descarta o lote atual, para que um processo filho ( fork ) não repita os ids do processo pai.
+
+    A trava também é recriada, já que o fork pode ter acontecido com ela adquirida por outra thread.
+    """
+    global _lote_ids, _pos_lote_ids, _trava_ids
+    _lote_ids = b''
+    _pos_lote_ids = 0
+    _trava_ids = threading.Lock()
+
+def _recriar_trava_vencimentos() -> None:
+    """Recria a trava de Emprestimo.vencimentos no processo filho ( fork ), pelo mesmo motivo de _descartar_lote_ids."""
+    global _trava_vencimentos
+    _trava_vencimentos = threading.Lock()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_descartar_lote_ids)
+    os.register_at_fork(after_in_child=_recriar_trava_vencimentos)
+
+def _dias_atraso(vencimento: int, ref: int) -> int:
+    """Regra única de atraso, usada por Emprestimo.dias_atraso e Emprestimo.dias_atraso_todos.
+
+    Args:
+        vencimento (int): data_prev_devol.toordinal() do empréstimo
+        ref (int): data de referência, também em toordinal()
+
+    Returns:
+        int: dias de atraso, 0 caso a data de referência ainda não tenha passado do vencimento
+    """
+    dias = ref - vencimento
+    return dias if dias > 0 else 0
 
 class BaseEntity:
     """Classe pai, usada para a criação de um id único e comparação ==.
 
     Attributes:
-        id (UUID): id gerado pelo uuid4(), único
+        id (bytes): id de 16 bytes gerado pelo _novo_id(), único
         data_criacao (date): data em que a instância foi criada
+        _hash (int): hash do id, calculado uma vez na criação
     """
 
-    __slots__ = ['id', 'data_criacao']
+    __slots__ = ['id', 'data_criacao', '_hash', '__weakref__']
 
-    def __init__(self) -> None:
+    def __init__(self, data_criacao: date = None) -> None:
         """Inicializa BaseEntity.
+
+        Args:
+            data_criacao (date): data de criação já calculada, evita um date.today() por entidade em criações em lote ( por padrão o dia atual )
         """
-        self.id = self._gerar_id
-        self.data_criacao = date.today()
+        if data_criacao is None:
+            data_criacao = date.today()
+        #Entidades criadas no mesmo dia compartilham o mesmo objeto date
+        self.id = _novo_id()
+        self._hash = hash(self.id)
+        self.data_criacao = _datas_criacao.setdefault(data_criacao, data_criacao)
+
+    def _iniciar(self, data_criacao: date) -> None:
+        """Preenche os atributos de BaseEntity nas criações em lote, que não passam pelo __init__.
+
+        Faz o mesmo que o __init__, que não chama este método para não ter uma chamada a mais por entidade.
+
+        Args:
+            data_criacao (date): data de criação da entidade
+        """
+        #Entidades criadas no mesmo dia compartilham o mesmo objeto date
+        self.id = _novo_id()
+        self._hash = hash(self.id)
+        self.data_criacao = _datas_criacao.setdefault(data_criacao, data_criacao)
 
     def __eq__(self, other) -> bool:
         """Compara instâncias de BaseEntity, verificando se são do mesmo tipo e possuem o mesmo id.
@@ -27,29 +121,26 @@ class BaseEntity:
         Returns:
             bool: True caso iguais ( mesmo id e classe ), False caso contrário
         """
-        if isinstance(other, type(self)) and other.id == self.id:
-            return True
-        else:
-            return False
-        
-    def _gerar_id(self) -> uuid.UUID:
-        """Gera um id com a biblioteca uuid4(), para usar no __init__.
-        
+        return other.__class__ is self.__class__ and other.id == self.id
+
+    def __hash__(self) -> int:
+        """Hash baseado no id, necessário já que __eq__ foi definido, permite usar entidades como keys de dicionários.
+
         Returns:
-            UUID: um id único gerado pelo uuid4()
+            int: hash do id, já calculado no __init__
         """
-        return uuid.uuid4()
+        return self._hash
 
 class Obra(BaseEntity):
     """Uma obra única usada no acervo.
     
     Attributes:
-        id (UUID): id gerado pelo uuid4(), único
+        id (bytes): id de 16 bytes gerado pelo _novo_id(), único
         data_criacao (date): data em que a instância foi criada
         titulo (str): título da obra
-        autor (str): autor da obra
+        autor (str): autor da obra, internado com sys.intern() já que se repete entre obras
         ano (int): ano em que a obra foi publicada
-        categoria (str): categoria da obra
+        categoria (str): categoria da obra, internada com sys.intern() já que se repete entre obras
         quantidade (int): quantidade da obra
     """
 
@@ -67,11 +158,53 @@ class Obra(BaseEntity):
         """
         super().__init__()
         self.titulo = titulo
-        self.autor = autor
+        self.autor = sys.intern(autor)
         self.ano = ano
-        self.categoria = categoria
+        self.categoria = sys.intern(categoria)
         self.quantidade = quantidade
 
+    def _preencher(self, titulo: str, autor: str, ano: int, categoria: str, quantidade: int) -> None:
+        """Preenche os atributos próprios de Obra em criar_em_lote, que não passa pelo __init__.
+
+        Faz o mesmo que o __init__, que não chama este método para não ter uma chamada a mais por obra.
+
+        Args:
+            titulo (str): título da obra
+            autor (str): autor da obra
+            ano (int): ano em que a obra foi publicada
+            categoria (str): categoria da obra
+            quantidade (int): quantidade da obra
+        """
+        self.titulo = titulo
+        self.autor = sys.intern(autor)
+        self.ano = ano
+        self.categoria = sys.intern(categoria)
+        self.quantidade = quantidade
+
+    @classmethod
+    def criar_em_lote(cls, linhas: list) -> list:
+        """Cria várias obras de uma vez, para importações grandes.
+
+        Tem o mesmo efeito de chamar Obra(...) para cada linha, mas sem passar pelo __init__ de cada uma,
+        e com um único date.today() para todas
+
+        Args:
+            linhas (list): lista de tuplas no formato (titulo, autor, ano, categoria, quantidade)
+
+        Returns:
+            list: as obras criadas, na mesma ordem das linhas
+        """
+        hoje = date.today()
+        novo = object.__new__
+
+        obras = []
+        for linha in linhas:
+            obra = novo(cls)
+            obra._iniciar(hoje)
+            obra._preencher(*linha)
+            obras.append(obra)
+        return obras
+
     def disponivel(self, estoque: dict) -> bool:
         """Verifica se a obra está no estoque do acervo.
 
@@ -81,10 +214,7 @@ class Obra(BaseEntity):
         Returns:
             bool: True caso esteja no estoque, False caso contrário
         """
-        if self.titulo in estoque:
-            return True
-        else: 
-            return False
+        return self.titulo in estoque
         
     def __str__(self) -> str:
         """Retorna uma string para representar o objeto.
@@ -98,18 +228,18 @@ class Usuario(BaseEntity):
     """Um usuário do serviço de acervo.
 
     Attributes:
-        id (UUID): id gerado pelo uuid4(), único
+        id (bytes): id de 16 bytes gerado pelo _novo_id(), único
         data_criacao (date): data em que a instância foi criada
         nome (str): nome do usuário
         email (str): email do usuário
         emprestimos (list): lista de empréstimos já feitos
-        debitos (dict): lista de débitos já feitos, no formato {"motivo": preço}
-        historico (list, de classe): Armazena todos os usuários
+        debitos (list): lista de multas de atraso já feitas, no formato (emprestimo, data, valor), o texto só é montado no relatório
+        historico (WeakSet, de classe): Armazena os usuários ainda em uso, os que não são mais referenciados saem sozinhos, quem já fez empréstimo fica, por causa de Emprestimo.historico
     """
 
     __slots__ = ['nome', 'email', 'emprestimos', 'debitos']
 
-    historico = []
+    historico = WeakSet()
 
     def __init__(self, nome: str, email: str) -> None:
         """Inicializa Usuario.
@@ -123,8 +253,8 @@ class Usuario(BaseEntity):
         self.nome = nome
         self.email = email
         self.emprestimos = []
-        self.debitos = {}
-        Usuario.historico.append(self)
+        self.debitos = []
+        Usuario.historico.add(self)
 
     def __lt__(self, other) -> bool:
         """Compara instâncias do Usuario, usando seus nomes como parâmetro de verificação.
@@ -160,21 +290,23 @@ class Emprestimo(BaseEntity):
     """Representa um empréstimo, associando o usuário com a obra emprestada.
     
     Attributes:
-        id (UUID): id gerado pelo uuid4(), único
+        id (bytes): id de 16 bytes gerado pelo _novo_id(), único
         data_criacao (date): data em que a instância foi criada
         obra (Obra): Obra associada ao empréstimo
         usuario (Usuario): Usuário associada ao empréstimo
         data_prev_devol (date): Data prevista para devolução
         data_retirada (date): Data em que ocorreu o empréstimo
         data_dev_real (date):  Data em que ocorrerá a devolução, maior prioridade, mas por padrão, None
-        historico (list, de classe): Armazena todos os empréstimos já registrados
+        historico (deque, de classe): Armazena todos os empréstimos já registrados
+        vencimentos (array, de classe): Coluna com data_prev_devol.toordinal() de cada empréstimo, na mesma ordem de historico
     """
 
-    __slots__ = ['obra', 'usuario', 'data_prev_devol', 'data_retirada', 'data_dev_real']
+    __slots__ = ['obra', 'usuario', '_data_prev_devol', '_idx', 'data_retirada', 'data_dev_real', '_str_devolvido']
 
-    historico = []
+    historico = deque()
+    vencimentos = array('i')
 
-    def __init__(self, obra: Obra, usuario: Usuario, data_prev_devol: date = date.today() + timedelta(days=7), data_retirada: date = date.today()) -> None:
+    def __init__(self, obra: Obra, usuario: Usuario, data_prev_devol: date = None, data_retirada: date = None) -> None:
         """Inicializa Emprestimo.
 
         Args:
@@ -184,14 +316,44 @@ class Emprestimo(BaseEntity):
             data_retirada (date): Data em que ocorreu o empréstimo ( por padrão o dia atual, date.today() )
         """
 
-        super().__init__()
+        hoje = date.today()
+        super().__init__(hoje)
+        if data_retirada is None:
+            data_retirada = hoje
+        if data_prev_devol is None:
+            data_prev_devol = hoje + _SETE_DIAS
+
         self.obra = obra
         self.usuario = usuario
         self.data_retirada = data_retirada
-        self.data_prev_devol = data_prev_devol
+        self._data_prev_devol = data_prev_devol
+        #Índice e append juntos sob a trava, senão duas threads podem pegar o mesmo _idx
+        with _trava_vencimentos:
+            self._idx = len(Emprestimo.vencimentos)
+            Emprestimo.vencimentos.append(data_prev_devol.toordinal())
         self.data_dev_real = None
+        self._str_devolvido = None
         Emprestimo.historico.append(self)
 
+    @property
+    def data_prev_devol(self) -> date:
+        """Data prevista para devolução, ao ser alterada também atualiza Emprestimo.vencimentos.
+
+        Returns:
+            date: Data prevista para devolução
+        """
+        return self._data_prev_devol
+
+    @data_prev_devol.setter
+    def data_prev_devol(self, data_prev_devol: date) -> None:
+        """Altera a data prevista para devolução, mantendo Emprestimo.vencimentos[self._idx] em dia.
+
+        Args:
+            data_prev_devol (date): Nova data prevista para devolução
+        """
+        self._data_prev_devol = data_prev_devol
+        Emprestimo.vencimentos[self._idx] = data_prev_devol.toordinal()
+
     def marcar_devolucao(self, data_dev_real: date) -> None:
         """Registra data de devolução.
 
@@ -199,8 +361,9 @@ class Emprestimo(BaseEntity):
             data_dev_real (date): Data de devolução real
         """
         self.data_dev_real = data_dev_real
+        self._str_devolvido = f'Empréstimo da obra {self.obra}, Devolvido em {data_dev_real.strftime('%d/%m/%y')}.'
 
-    def dias_atraso(self, data_ref: date = date.today()) -> int:
+    def dias_atraso(self, data_ref: date = None) -> int:
         """Calcula quantos dias de atraso entre a data de referência e a data de devolução, retorna 0 caso em dia
 
         Args:
@@ -209,20 +372,39 @@ class Emprestimo(BaseEntity):
         Returns:
             int: Quantidade de dias que a devolução está em atraso, retorna 0 caso esteja em dia
         """
-        return abs((self.data_prev_devol - data_ref).days)
+        if data_ref is None:
+            data_ref = date.today()
+        return _dias_atraso(Emprestimo.vencimentos[self._idx], data_ref.toordinal())
+
+    @classmethod
+    def dias_atraso_todos(cls, data_ref: date = None) -> list:
+        """Calcula dias_atraso de todos os empréstimos de uma vez, direto sobre a coluna Emprestimo.vencimentos
+
+        Args:
+            data_ref (date): Data de referência para a comparação, ( por padrão o dia atual )
+
+        Returns:
+            list: Dias de atraso de cada empréstimo, na mesma ordem de Emprestimo.historico
+        """
+        if data_ref is None:
+            data_ref = date.today()
+        ref = data_ref.toordinal()
+        return [_dias_atraso(venc, ref) for venc in cls.vencimentos]
 
     def __str__(self) -> str:
         """Retorna uma string para representar o objeto no print.
         
+        Depois da devolução o texto não muda mais, então é montado uma vez só em marcar_devolucao
+
         Returns:
             str: 'prev: dd/mm'
         """
-        string = f'Empréstimo da obra {self.obra}'
-        if not self.data_dev_real:
-            string += f', Data prev de devolução: {self.data_prev_devol}'
-            if self.dias_atraso():
-                string += f', Atrasado.'
-            else:
-                string += f', Em dia.'
+        if self._str_devolvido is not None:
+            return self._str_devolvido
+
+        string = f'Empréstimo da obra {self.obra}, Data prev de devolução: {self.data_prev_devol}'
+        if self.dias_atraso():
+            string += f', Atrasado.'
         else:
-            string += f', Devolvido em {self.data_dev_real.strftime('%d/%m/%y')}.'
+            string += f', Em dia.'
+        return string
@@ -1,4 +1,5 @@
 from datetime import date, timedelta
+import gc
 
 from rich.console import Console
 
@@ -27,3 +28,55 @@ print(u1.debitos)
 console.print(acervo._relatorio_builder('inv'))
 console.print(acervo._relatorio_builder('user_deb', u1))
 console.print(acervo._relatorio_builder('user_mov', u1))
+
+#Empréstimo já vencido, para o relatório de empréstimos ativos
+u2 = models.Usuario('Ana', 'bbb@gmail.com')
+emp2 = acervo.emprestar(o2, u2, dias=-3)
+console.print(acervo._relatorio_builder('emp_ativos'))
+
+#Texto de um empréstimo em atraso e de um já devolvido
+print(emp2)
+print(emp1)
+
+#Obra com uma unidade só sai do estoque no empréstimo e volta com 1 na devolução
+o4 = models.Obra('Memórias Póstumas de Brás Cubas', 'Machado de Assis', 1881, 'Romance/Literatura Clássica')
+acervo.adicionar(o4)
+emp3 = acervo.emprestar(o4, u2)
+print(acervo.estoque)
+acervo.devolver(emp3)
+print(acervo.estoque)
+
+#Renovação antes do vencimento, sem multa
+emp4 = acervo.emprestar(o3, u2)
+acervo.renovar(emp4)
+print(emp4)
+print(u2.debitos)
+
+#Usuários em ordem alfabética
+console.print(acervo._relatorio_builder('user_hist'))
+
+#Histórico de empréstimos, com a contagem de atrasados
+console.print(acervo._relatorio_builder('emp_hist'))
+
+#A lista ordenada do estoque é refeita depois de emprestar e devolver
+print(acervo.estoque_ordenado())
+emp5 = acervo.emprestar(o1, u1)
+print(acervo.estoque_ordenado())
+acervo.devolver(emp5)
+print(acervo.estoque_ordenado())
+
+#Importação em lote
+lote = models.Obra.criar_em_lote([
+    ('Dom Casmurro', 'Machado de Assis', 1899, 'Romance/Literatura Clássica', 3),
+    ('O Hobbit', 'J.R.R Tolkien', 1937, 'Fantasia Épica', 2),
+])
+for obra in lote:
+    acervo.adicionar(obra)
+console.print(acervo._relatorio_builder('inv'))
+
+#Usuário sem empréstimos sai do histórico quando não é mais referenciado
+u3 = models.Usuario('Bruno', 'ccc@gmail.com')
+print(len(models.Usuario.historico))
+del u3
+gc.collect()
+print(len(models.Usuario.historico))